@@ -1,11 +1,35 @@
 import os
 import sys
+import zlib
+import json
+import mmap
+import bisect
 import time
+import queue
 import socket
+import hashlib
+import struct
 import logging
+import itertools
 import threading
+from collections import deque
 from tqdm import tqdm
 
+# Optional codecs, used when installed
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+# Optional, used to watch the input file instead of polling it
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
 # Configurations
 SERVER_HOST = socket.gethostbyname(socket.gethostname())
 SERVER_PORT = 12345
@@ -13,78 +37,661 @@ BUFFER_SIZE = 1024
 INPUT_FILE = 'input.txt'
 DOWNLOAD_FOLDER = 'downloads'
 
+# Download manager configuration
+MAX_FILE_SETUPS = 3  # Files looking up their mirrors and manifest at the same time, transfers are not limited
+MAX_STREAMS = 8  # Connections downloading chunks at the same time, across all files
+MAX_BANDWIDTH = 0  # Bytes per second across all downloads, 0 for unlimited
+FILE_RETRIES = 2  # Times a failed download is queued again
+INPUT_POLL_INTERVAL = 0.5  # Seconds between checks of the input file when inotify is not available
+WATCH_TIMEOUT = 1.0  # Seconds to wait for the input file to change before checking it anyway
+UNTERMINATED_LINE_TIMEOUT = 5.0  # Seconds a last line without a newline must stay unchanged before it is taken as complete
+MISSING_FILE_RETRY_INTERVAL = 5  # Seconds between checks for files that were not on the server
+
+# Multi-source configuration
+MIRRORS = [f"{SERVER_HOST}:{SERVER_PORT}"]  # host:port of every server instance, the command line overrides it
+STREAMS_PER_SOURCE = 2
+RANGE_SIZE = 1024 * 1024  # Unit of work pulled by the sources, faster sources pull more of them
+SOURCE_TIMEOUT = 10  # Seconds without data before a request to a source fails
+MAX_SOURCE_FAILURES = 3  # Failed ranges after which a source is dropped
+SLOW_SOURCE_RATIO = 0.2  # Sources slower than this fraction of the fastest one are dropped
+MIN_SOURCE_SAMPLES = 2  # Ranges a source must complete before its speed is judged
+THROUGHPUT_SMOOTHING = 0.3  # Weight of the latest range in the smoothed throughput of a source
+
+# Compression configuration
+BLOCK_HEADER = struct.Struct("!BII")  # codec id, raw length, payload length
+DECOMPRESSORS = {0: bytes, 1: zlib.decompress}
+if lz4 is not None:
+    DECOMPRESSORS[2] = lz4.frame.decompress
+if zstandard is not None:
+    DECOMPRESSORS[3] = lambda payload: zstandard.ZstdDecompressor().decompress(payload)
+# Codecs offered to the server, in order of preference
+ACCEPTED_CODECS = ",".join(name for name, codec_id in (("zstd", 3), ("lz4", 2), ("zlib", 1)) if codec_id in DECOMPRESSORS)
+
+# Manifest and delta sync configuration
+MANIFEST_HEADER = struct.Struct("!I")  # length of the JSON payload
+VERIFY_RETRIES = 3  # Times the blocks of a part that fail verification are fetched again
+ADLER_MOD = 65521
+DELTA_GIVE_UP_BYTES = 256 * 1024  # Bytes rolled through without a match before skipping as many bytes of a changed region
+DELTA_UNRELATED_BYTES = 4 * 1024 * 1024  # Stop scanning a local copy that shares nothing with the server's file after this many bytes
+
 non_existent_files = set()
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def list_files():
-    """Retrieve the list of available files from the server and display this information."""
+class BandwidthLimiter:
+    """Token bucket shared by every stream, a rate of 0 disables the limit."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last_update = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """Take `amount` bytes from the bucket, sleeping while it is in debt."""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last_update) * self.rate)
+            self.last_update = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+class StreamScheduler:
+    """Run stream tasks on a fixed number of threads, tasks of smaller downloads first."""
+
+    def __init__(self, max_streams):
+        self.queue = queue.PriorityQueue()
+        self.order = itertools.count()
+        for _ in range(max_streams):
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, priority, task, *args):
+        self.queue.put((priority, next(self.order), task, args))
+
+    def run(self):
+        while True:
+            _, _, task, args = self.queue.get()
+            try:
+                task(*args)
+            except Exception as e:
+                logging.error(f"Error in stream task: {e}")
+
+# Shared by every file being downloaded
+stream_scheduler = StreamScheduler(MAX_STREAMS)
+bandwidth_limiter = BandwidthLimiter(MAX_BANDWIDTH)
+
+class InputFileWatcher:
+    """Follow the input file and return only the lines appended since the last read."""
+
+    def __init__(self, path):
+        self.path = path
+        self.inode = None
+        self.offset = 0
+        self.pending = b""
+        self.pending_since = 0.0
+        self.inotify = None
+        if INotify is not None:
+            try:
+                self.inotify = INotify()
+                # Watch the directory, editors often replace the file instead of writing to it
+                self.inotify.add_watch(os.path.dirname(os.path.abspath(path)),
+                                       flags.MODIFY | flags.CLOSE_WRITE | flags.CREATE | flags.MOVED_TO)
+            except OSError as e:
+                logging.warning(f"Cannot watch {path} with inotify, polling it instead: {e}")
+                self.inotify = None
+
+    def read_new_lines(self):
+        """Return the complete lines appended since the last call."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return []
+        from_start = stat.st_ino != self.inode or stat.st_size < self.offset
+        if from_start:
+            # The file was replaced or truncated, read it again from the start
+            self.inode, self.offset, self.pending = stat.st_ino, 0, b""
+        data = b""
+        if stat.st_size > self.offset:
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+            self.offset += len(data)
+        lines = (self.pending + data).split(b"\n")
+        if data:
+            self.pending_since = time.monotonic()
+        self.pending = lines.pop()
+        if self.pending and (from_start or time.monotonic() - self.pending_since >= UNTERMINATED_LINE_TIMEOUT):
+            # The last line has no newline, take it as complete when the file was read whole or stopped changing long ago
+            lines.append(self.pending)
+            self.pending = b""
+        return [line.decode(errors="replace").strip() for line in lines if line.strip()]
+
+    def wait(self):
+        """Block until the input file may have changed."""
+        if self.inotify is not None:
+            self.inotify.read(timeout=int(WATCH_TIMEOUT * 1000))
+        else:
+            time.sleep(INPUT_POLL_INTERVAL)
+
+class DownloadManager:
+    """Download queued files concurrently, smallest first, sharing the stream pool and bandwidth limit.
+
+    Only the lookup of a file's mirrors and manifest takes one of the setup slots. The transfer then runs in
+    its own thread and is limited by the stream scheduler and bandwidth limiter alone, so a small file queued
+    behind large ones starts right away and its streams overtake theirs.
+    """
+
+    def __init__(self, max_setups):
+        self.queue = queue.PriorityQueue()
+        self.order = itertools.count()
+        for _ in range(max_setups):
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, filename, file_size, attempt=0):
+        self.queue.put((file_size, next(self.order), filename, attempt))
+
+    def run(self):
+        while True:
+            file_size, _, filename, attempt = self.queue.get()
+            try:
+                manifest, size, sources = choose_sources(filename, file_size)
+            except Exception as e:
+                self.failed(filename, file_size, attempt, e)
+            else:
+                threading.Thread(target=self.transfer, args=(filename, file_size, attempt, manifest, size, sources),
+                                 daemon=True).start()
+            finally:
+                self.queue.task_done()
+
+    def transfer(self, filename, file_size, attempt, manifest, size, sources):
+        try:
+            download_file(filename, manifest, size, sources)
+        except Exception as e:
+            self.failed(filename, file_size, attempt, e)
+
+    def failed(self, filename, file_size, attempt, error):
+        """Log a failed download and queue it again while it has retries left."""
+        logging.error(f"Error downloading {filename}: {error}")
+        if attempt < FILE_RETRIES:
+            self.submit(filename, file_size, attempt + 1)
+
+def parse_endpoint(mirror):
+    """Split a host:port mirror address."""
+    host, port = mirror.rsplit(":", 1)
+    return host, int(port)
+
+def list_files(endpoint):
+    """Retrieve the list of available files from a server and display this information."""
+    host, port = endpoint
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-            client_socket.connect((SERVER_HOST, SERVER_PORT))
+            client_socket.connect(endpoint)
             client_socket.sendall(b"LIST")
             response = client_socket.recv(BUFFER_SIZE).decode()
             if response == "NO_FILES_AVAILABLE":
-                print("No files available on the server.")
-                sys.exit(0)
+                print(f"No files available on {host}:{port}.")
             else:
-                print("Available files on the server:")
+                print(f"Available files on {host}:{port}:")
                 print(response)
     except ConnectionRefusedError:
-        logging.error("Error retrieving file list: Connection refused.")
+        logging.error(f"Error retrieving file list from {host}:{port}: Connection refused.")
     except Exception as e:
-        logging.error(f"Error retrieving file list: {e}")
+        logging.error(f"Error retrieving file list from {host}:{port}: {e}")
 
-def download_chunk(filename, part_num, offset, chunk_size, total_size, progress_bar_main, lock):
-    """Downloads a chunk of a file."""
-    try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-            client_socket.connect((SERVER_HOST, SERVER_PORT))
-            request = f"DOWNLOAD:{filename}:{offset}:{chunk_size}"
-            client_socket.send(request.encode())
-            received_data = b''
-            bytes_received = 0
-
-            progress_bar_part = tqdm(
-                total=chunk_size,
-                desc=f"Part {part_num + 1}",
-                unit="B",
-                unit_scale=True,
-                unit_divisor=1024,
-                leave=False,
-                position=part_num + 1,
-                bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}]'
-            )
-
-            while bytes_received < chunk_size:
-                chunk = client_socket.recv(min(BUFFER_SIZE, chunk_size - bytes_received))
-                if not chunk:
+def recv_exact(client_socket, size):
+    """Receive exactly `size` bytes from the socket."""
+    data = bytearray()
+    while len(data) < size:
+        packet = client_socket.recv(size - len(data))
+        if not packet:
+            raise ConnectionError("Connection closed by server")
+        bandwidth_limiter.consume(len(packet))
+        data += packet
+    return bytes(data)
+
+def receive_blocks(client_socket):
+    """Yield the decompressed blocks of a compressed DOWNLOAD response until the end marker."""
+    while True:
+        header = recv_exact(client_socket, BLOCK_HEADER.size)
+        if header.startswith(b"ERROR"):
+            raise RuntimeError((header + client_socket.recv(BUFFER_SIZE)).decode(errors="replace"))
+        codec_id, raw_length, payload_length = BLOCK_HEADER.unpack(header)
+        if raw_length == 0:
+            return
+        block = DECOMPRESSORS[codec_id](recv_exact(client_socket, payload_length))
+        if len(block) != raw_length:
+            raise ValueError(f"Block decompressed to {len(block)} bytes, expected {raw_length}")
+        yield block
+
+def fetch_range(filename, offset, size, endpoint, progress=None):
+    """Download a range of a file from one server in one request and return its data."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
+        client_socket.settimeout(SOURCE_TIMEOUT)
+        client_socket.connect(endpoint)
+        client_socket.sendall(f"DOWNLOAD:{filename}:{offset}:{size}:{ACCEPTED_CODECS}".encode())
+        data = bytearray()
+        for block in receive_blocks(client_socket):
+            data += block
+            if progress is not None:
+                progress(len(block))
+        return data
+
+def find_corrupt_blocks(data, offset, manifest):
+    """Return the positions in a downloaded range of the blocks that do not match the manifest."""
+    block_size = manifest["block_size"]
+    return [
+        start for start in range(0, len(data), block_size)
+        if hashlib.sha256(data[start:start + block_size]).hexdigest() != manifest["blocks"][(offset + start) // block_size][1]
+    ]
+
+def verify_range(filename, offset, data, manifest, endpoint):
+    """Check a downloaded range against the manifest, re-fetching in place only the blocks that fail."""
+    block_size = manifest["block_size"]
+    for attempt in range(VERIFY_RETRIES + 1):
+        corrupt_blocks = find_corrupt_blocks(data, offset, manifest)
+        if not corrupt_blocks:
+            return
+        if attempt == VERIFY_RETRIES:
+            break
+        logging.warning(f"Range at {offset} of {filename}: {len(corrupt_blocks)} blocks failed verification, fetching them again")
+        for start in corrupt_blocks:
+            size = min(block_size, len(data) - start)
+            try:
+                block = fetch_range(filename, offset + start, size, endpoint)
+            except Exception as e:
+                logging.error(f"Error fetching block at {offset + start} of {filename} again: {e}")
+                continue
+            data[start:start + size] = block[:size].ljust(size, b"\0")
+    raise ValueError(f"Range at {offset} of {filename} still fails verification after {VERIFY_RETRIES} retries")
+
+class Source:
+    """A server that has the file being downloaded, with its observed throughput."""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.name = f"{endpoint[0]}:{endpoint[1]}"
+        self.throughput = 0.0  # Bytes per second of one stream, smoothed
+        self.samples = 0
+        self.failures = 0
+        self.dropped = False
+
+    def record(self, size, elapsed):
+        rate = size / max(elapsed, 1e-6)
+        if self.samples:
+            rate = (1 - THROUGHPUT_SMOOTHING) * self.throughput + THROUGHPUT_SMOOTHING * rate
+        self.throughput = rate
+        self.samples += 1
+
+class MultiSourceDownload:
+    """
+    Download the ranges of one file from several sources at once.
+
+    Every source runs up to STREAMS_PER_SOURCE streams that pull ranges from a shared queue, so each source gets a
+    share of the ranges that follows its throughput. A stream fetches one range per task and then queues itself
+    again, so the streams of smaller downloads overtake those of larger ones. Failed ranges go back to the queue,
+    and sources that keep failing or fall far behind the fastest one are dropped.
+    """
+
+    def __init__(self, filename, ranges, sources, manifest, output_path, progress_bar):
+        self.filename = filename
+        self.sources = sources
+        self.manifest = manifest
+        self.output_path = output_path
+        self.progress_bar = progress_bar
+        self.progress_lock = threading.Lock()
+        self.pending = deque(ranges)
+        self.remaining = sum(size for _, size in ranges)  # Bytes left to fetch, the priority of the next stream task
+        self.in_flight = 0
+        self.streams = {source.endpoint: 0 for source in sources}  # Stream tasks of each source, queued or running
+        self.condition = threading.Condition()
+
+    def run(self):
+        """Download every range, raising if some are left when no source remains."""
+        if not self.sources:
+            raise RuntimeError(f"No source for {self.filename}")
+        with self.condition:
+            self.start_streams()
+            while (self.pending or self.in_flight) and any(self.streams.values()):
+                self.condition.wait()
+        if self.pending:
+            raise RuntimeError(f"No source left for {len(self.pending)} ranges of {self.filename}")
+        for source in self.sources:
+            if source.samples:
+                logging.info(f"{self.filename}: {source.name} served {source.samples} ranges at {source.throughput / 1024:.0f} KB/s per stream")
+
+    def start_streams(self):
+        """Queue a stream for every free stream slot of the sources left, called with the condition held."""
+        if not self.pending:
+            return
+        for source in self.sources:
+            while not source.dropped and self.streams[source.endpoint] < STREAMS_PER_SOURCE:
+                self.streams[source.endpoint] += 1
+                stream_scheduler.submit(self.remaining, self.work, source)
+
+    def next_range(self, source):
+        """Take the next pending range, ending the stream when there is none."""
+        with self.condition:
+            if source.dropped or not self.pending:
+                self.streams[source.endpoint] -= 1
+                self.condition.notify_all()
+                return None
+            self.in_flight += 1
+            return self.pending.popleft()
+
+    def finish_range(self, byte_range, source, elapsed=None):
+        """Record the outcome of a range, `elapsed` is None when it failed, and queue the stream again."""
+        with self.condition:
+            self.in_flight -= 1
+            if elapsed is None:
+                self.pending.appendleft(byte_range)
+                source.failures += 1
+                if source.failures >= MAX_SOURCE_FAILURES and not source.dropped:
+                    source.dropped = True
+                    logging.warning(f"Dropping source {source.name} for {self.filename}: too many failures")
+            else:
+                self.remaining -= byte_range[1]
+                source.record(byte_range[1], elapsed)
+                judged = [other for other in self.sources if not other.dropped and other.samples >= MIN_SOURCE_SAMPLES]
+                if (source.samples >= MIN_SOURCE_SAMPLES and len(judged) > 1
+                        and source.throughput < SLOW_SOURCE_RATIO * max(other.throughput for other in judged)):
+                    source.dropped = True
+                    logging.warning(f"Dropping source {source.name} for {self.filename}: too slow")
+            if not source.dropped and self.pending:
+                stream_scheduler.submit(self.remaining, self.work, source)
+            else:
+                self.streams[source.endpoint] -= 1
+            # A failed range may need a stream from a source whose streams already ended
+            self.start_streams()
+            self.condition.notify_all()
+
+    def update_progress(self, amount):
+        with self.progress_lock:
+            self.progress_bar.update(amount)
+
+    def work(self, source):
+        """Fetch one range from a source."""
+        byte_range = self.next_range(source)
+        if byte_range is None:
+            return
+        offset, size = byte_range
+        received = [0]
+
+        def progress(amount):
+            received[0] += amount
+            self.update_progress(amount)
+
+        started = time.monotonic()
+        try:
+            data = fetch_range(self.filename, offset, size, source.endpoint, progress)
+            if self.manifest is not None:
+                # A short response leaves zeroed blocks, which fail verification and are fetched again
+                data.extend(bytes(max(0, size - len(data))))
+                verify_range(self.filename, offset, data, self.manifest, source.endpoint)
+            elif len(data) != size:
+                raise ValueError(f"Received {len(data)} bytes instead of {size}")
+            with open(self.output_path, 'r+b') as f:
+                f.seek(offset)
+                f.write(data[:size])
+        except Exception as e:
+            logging.warning(f"Source {source.name} failed on the range at {offset} of {self.filename}: {e}")
+            self.update_progress(-received[0])
+            self.finish_range(byte_range, source)
+        else:
+            self.finish_range(byte_range, source, time.monotonic() - started)
+
+def split_ranges(ranges, range_size):
+    """Cut (offset, size) ranges into pieces of at most `range_size` bytes."""
+    return [(offset + start, min(range_size, size - start)) for offset, size in ranges for start in range(0, size, range_size)]
+
+def get_range_size(manifest):
+    """Size of the ranges pulled by the sources, a whole number of manifest blocks so each range can be verified."""
+    if manifest is None:
+        return RANGE_SIZE
+    return max(1, RANGE_SIZE // manifest["block_size"]) * manifest["block_size"]
+
+def merkle_root(leaves):
+    """Hash pairs of nodes level by level until a single root remains, carrying odd nodes up unchanged."""
+    level = leaves or [hashlib.sha256(b"").hexdigest()]
+    while len(level) > 1:
+        level = [
+            hashlib.sha256("".join(level[i:i + 2]).encode()).hexdigest() if i + 1 < len(level) else level[i]
+            for i in range(0, len(level), 2)
+        ]
+    return level[0]
+
+def request_manifest(filename, endpoint):
+    """Retrieve the block hashes and Merkle root of a file from a server, checking that they agree."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
+        client_socket.settimeout(SOURCE_TIMEOUT)
+        client_socket.connect(endpoint)
+        client_socket.sendall(f"MANIFEST:{filename}".encode())
+        header = recv_exact(client_socket, MANIFEST_HEADER.size)
+        if header == b"ERRO":
+            raise RuntimeError((header + client_socket.recv(BUFFER_SIZE)).decode(errors="replace"))
+        (length,) = MANIFEST_HEADER.unpack(header)
+        manifest = json.loads(recv_exact(client_socket, length).decode())
+    if merkle_root([strong for _, strong in manifest["blocks"]]) != manifest["root"]:
+        raise ValueError(f"Manifest of {filename} does not match its Merkle root")
+    return manifest
+
+def roll_checksum(checksum, removed, added, block_size):
+    """Slide an Adler-32 checksum one byte forward over the data."""
+    a = ((checksum & 0xFFFF) - removed + added) % ADLER_MOD
+    b = ((checksum >> 16) - block_size * removed + a - 1) % ADLER_MOD
+    return (b << 16) | a
+
+def find_local_blocks(local_path, blocks, block_size, file_size):
+    """
+    Find the blocks of the server's file that already exist anywhere in the local copy.
+
+    :return: dict mapping block index to the offset of an identical block in the local copy
+    """
+    matches = {}
+    local_size = os.path.getsize(local_path)
+    if local_size == 0 or not blocks:
+        return matches
+    weak_index = {}
+    for index, (weak, strong) in enumerate(blocks):
+        weak_index.setdefault(weak, []).append(index)
+
+    with open(local_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as local:
+        def match_window(position, checksum):
+            """Record the blocks of the server's file identical to the local window at `position`."""
+            candidates = weak_index.get(checksum)
+            if not candidates:
+                return False
+            strong = hashlib.sha256(local[position:position + block_size]).hexdigest()
+            found = [index for index in candidates if blocks[index][1] == strong]
+            for index in found:
+                matches.setdefault(index, position)
+            return bool(found)
+
+        # Blocks that did not move are found with one hash per block
+        aligned = [
+            position for position in range(0, local_size - block_size + 1, block_size)
+            if match_window(position, zlib.adler32(local[position:position + block_size]))
+        ]
+        aligned_set = set(aligned)
+
+        # Roll through the gaps between them, where inserted or removed bytes shifted the blocks,
+        # jumping a whole block after every match
+        position = 0
+        while position + block_size <= local_size:
+            if position in aligned_set:
+                position += block_size
+                continue
+            next_aligned = bisect.bisect_right(aligned, position)
+            gap_end = aligned[next_aligned] if next_aligned < len(aligned) else local_size
+            last_match = position
+            budget = DELTA_GIVE_UP_BYTES
+            checksum = None
+            while position < gap_end and position + block_size <= local_size:
+                if checksum is None:
+                    checksum = zlib.adler32(local[position:position + block_size])
+                if match_window(position, checksum):
+                    position += block_size
+                    last_match = position
+                    budget = DELTA_GIVE_UP_BYTES
+                    checksum = None
+                    continue
+                if position + block_size == local_size:
+                    position = gap_end
                     break
-                received_data += chunk
-                bytes_received += len(chunk)
-                progress_bar_part.update(len(chunk))
-                with lock:
-                    progress_bar_main.update(len(chunk))
+                if position - last_match >= budget:
+                    if not matches and position >= DELTA_UNRELATED_BYTES:
+                        # The local copy shares nothing with the server's file
+                        position = local_size
+                        break
+                    # Skip part of the changed region, then roll over one block, which is enough to find
+                    # the blocks after it whatever their shift
+                    position = min(position + DELTA_GIVE_UP_BYTES, gap_end)
+                    last_match = position
+                    budget = block_size
+                    checksum = None
+                    continue
+                checksum = roll_checksum(checksum, local[position], local[position + block_size], block_size)
+                position += 1
 
-            progress_bar_part.close()
+        # The last block is usually shorter, look for it at the same offset and at the end of the local copy
+        last_index = len(blocks) - 1
+        last_size = file_size - last_index * block_size
+        if last_index not in matches and last_size < block_size:
+            for offset in (last_index * block_size, local_size - last_size):
+                if 0 <= offset <= local_size - last_size:
+                    if hashlib.sha256(local[offset:offset + last_size]).hexdigest() == blocks[last_index][1]:
+                        matches[last_index] = offset
+                        break
+    return matches
 
-            temp_file = os.path.join(DOWNLOAD_FOLDER, f"{filename}.part{part_num}")
-            with open(temp_file, 'wb') as f:
-                f.write(received_data)
+def verify_blocks(file_path, blocks, block_size):
+    """Check every block of a file against its strong hash."""
+    with open(file_path, "rb") as f:
+        for weak, strong in blocks:
+            if hashlib.sha256(f.read(block_size)).hexdigest() != strong:
+                return False
+        return not f.read(1)
 
-    except Exception as e:
-        logging.error(f"Error downloading part {part_num}: {e}")
+def delta_sync(filename, manifest, sources):
+    """
+    Update the copy of a file already in the download folder by fetching only the blocks that differ.
 
+    :return: True if the local copy now matches the server's file
+    """
+    local_path = os.path.join(DOWNLOAD_FOLDER, filename)
+    file_size, block_size, blocks = manifest["size"], manifest["block_size"], manifest["blocks"]
+    matches = find_local_blocks(local_path, blocks, block_size, file_size)
 
-def download_file(filename, file_size):
+    # Merge consecutive missing blocks into ranges
+    ranges = []
+    for index in range(len(blocks)):
+        if index in matches:
+            continue
+        offset = index * block_size
+        size = min(block_size, file_size - offset)
+        if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + size)
+        else:
+            ranges.append((offset, size))
+    missing_size = sum(size for _, size in ranges)
+    if not ranges and os.path.getsize(local_path) == file_size and all(matches[index] == index * block_size for index in matches):
+        logging.info(f"{filename} is already up to date")
+        return True
+    logging.info(f"Delta sync of {filename}: reusing {len(matches)} of {len(blocks)} blocks, fetching {missing_size} bytes")
+
+    temp_path = f"{local_path}.delta"
+    try:
+        # Copy the blocks found in the local copy into place, the download fills in the others
+        with open(local_path, 'rb') as local_file, open(temp_path, 'wb') as outfile:
+            outfile.truncate(file_size)
+            for index, local_offset in matches.items():
+                local_file.seek(local_offset)
+                outfile.seek(index * block_size)
+                outfile.write(local_file.read(min(block_size, file_size - index * block_size)))
+
+        progress_bar_main = tqdm(
+            total=missing_size,
+            desc=f"Updating {filename}",
+            unit="B",
+            unit_scale=True,
+            unit_divisor=1024,
+            bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}]'
+        )
+        try:
+            MultiSourceDownload(filename, split_ranges(ranges, get_range_size(manifest)), sources, manifest,
+                                temp_path, progress_bar_main).run()
+        finally:
+            progress_bar_main.close()
+
+        if not verify_blocks(temp_path, blocks, block_size):
+            logging.warning(f"Delta sync of {filename} produced a corrupted file")
+            return False
+        os.replace(temp_path, local_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    logging.info(f"\nDelta sync completed: {filename}\n")
+    return True
+
+def find_sources(filename):
+    """Ask every mirror for its file list and return the size of the file on each mirror that has it."""
+    sources = {}
+    for mirror in MIRRORS:
+        endpoint = parse_endpoint(mirror)
+        try:
+            available_files = request_file_list(endpoint)
+        except Exception as e:
+            logging.warning(f"Error retrieving file list from {mirror}: {e}")
+            continue
+        if filename in available_files:
+            sources[endpoint] = available_files[filename]
+    return sources
+
+def choose_sources(filename, file_size):
+    """Find the mirrors serving the version of a file most of them agree on, returning its manifest, size and sources."""
+    source_sizes = find_sources(filename)
+    if not source_sizes:
+        raise FileNotFoundError(f"{filename} is not on any mirror")
+    # LIST reports the sizes of the server's catalog, which go stale when a file changes while the server runs,
+    # so the manifest of each mirror tells which version of the file it serves
+    manifests = {}
+    for endpoint in source_sizes:
+        try:
+            manifests[endpoint] = request_manifest(filename, endpoint)
+        except Exception as e:
+            logging.warning(f"No manifest for {filename} from {endpoint[0]}:{endpoint[1]}: {e}")
+    if manifests:
+        # Download the version most mirrors agree on, mirrors holding another version cannot serve its ranges
+        roots = [mirror_manifest["root"] for mirror_manifest in manifests.values()]
+        root = max(roots, key=roots.count)
+        sources = [Source(endpoint) for endpoint, mirror_manifest in manifests.items() if mirror_manifest["root"] == root]
+        manifest = manifests[sources[0].endpoint]
+        file_size = manifest["size"]
+    else:
+        manifest = None
+        logging.warning(f"Downloading {filename} without verification")
+        file_size = file_size if file_size in source_sizes.values() else next(iter(source_sizes.values()))
+        sources = [Source(endpoint) for endpoint, size in source_sizes.items() if size == file_size]
+    return manifest, file_size, sources
+
+def download_file(filename, manifest, file_size, sources):
     """Manages the file download."""
-    logging.info(f"Starting download: {filename} ({file_size} bytes)")
     os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
-    num_chunks = 4
-    chunk_size = file_size // num_chunks
-    threads = []
-    lock = threading.Lock()
+    local_path = os.path.join(DOWNLOAD_FOLDER, filename)
+    if manifest is not None and os.path.isfile(local_path):
+        try:
+            if delta_sync(filename, manifest, sources):
+                return
+        except Exception as e:
+            logging.error(f"Error during delta sync of {filename}: {e}")
+            for source in sources:
+                source.dropped = False
+                source.failures = 0
+    logging.info(f"Starting download: {filename} ({file_size} bytes) from {len(sources)} sources")
 
     progress_bar_main = tqdm(
         total=file_size,
@@ -92,75 +699,82 @@ def download_file(filename, file_size):
         unit="B",
         unit_scale=True,
         unit_divisor=1024,
-        position=0,
         bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}]'
     )
 
-    for i in range(num_chunks):
-        offset = i * chunk_size
-        size = chunk_size if i < num_chunks - 1 else file_size - offset
-        thread = threading.Thread(
-            target=download_chunk,
-            args=(filename, i, offset, size, file_size, progress_bar_main, lock),
-        )
-        threads.append(thread)
-        thread.start()
-
-    for thread in threads:
-        thread.join()
-
-    progress_bar_main.close()
-
-    output_file = os.path.join(DOWNLOAD_FOLDER, filename)
-    with open(output_file, 'wb') as outfile:
-        for i in range(num_chunks):
-            temp_file = os.path.join(DOWNLOAD_FOLDER, f"{filename}.part{i}")
-            with open(temp_file, 'rb') as infile:
-                outfile.write(infile.read())
-            os.remove(temp_file)
+    temp_path = f"{local_path}.part"
+    try:
+        with open(temp_path, 'wb') as f:
+            f.truncate(file_size)
+        MultiSourceDownload(filename, split_ranges([(0, file_size)], get_range_size(manifest)), sources, manifest,
+                            temp_path, progress_bar_main).run()
+        os.replace(temp_path, local_path)
+    finally:
+        progress_bar_main.close()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
     logging.info(f"\nDownload completed: {filename}\n")
 
+def request_file_list(endpoint):
+    """Retrieve the names and sizes of the files available on a server."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
+        client_socket.settimeout(SOURCE_TIMEOUT)
+        client_socket.connect(endpoint)
+        client_socket.send(b"LIST")
+        response = client_socket.recv(BUFFER_SIZE).decode()
+    available_files = {}
+    for line in response.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            available_files[parts[0]] = int(parts[1])
+    return available_files
+
 def process_input_file():
-    """process the input file and download files from the server."""
-    processed_files = set()
-    list_files()
+    """Watch the input file and queue every newly listed file for download."""
+    queued_files = set()
+    for mirror in MIRRORS:
+        list_files(parse_endpoint(mirror))
     global non_existent_files
+    download_manager = DownloadManager(MAX_FILE_SETUPS)
+    watcher = InputFileWatcher(INPUT_FILE)
+    last_missing_check = time.monotonic()
 
     while True:
-        try:
-            with open(INPUT_FILE, 'r') as f:
-                files_to_download = [line.strip() for line in f.readlines()]
-        except FileNotFoundError:
-            files_to_download = []
+        filenames = [filename for filename in watcher.read_new_lines() if filename not in queued_files]
+        if non_existent_files and time.monotonic() - last_missing_check >= MISSING_FILE_RETRY_INTERVAL:
+            # Files may have been added to the server since they were requested
+            filenames += [filename for filename in non_existent_files if filename not in filenames]
+            last_missing_check = time.monotonic()
 
-        for filename in files_to_download:
-            if filename not in processed_files:
+        if filenames:
+            available_files = {}
+            refused = 0
+            for mirror in MIRRORS:
                 try:
-                    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-                        client_socket.connect((SERVER_HOST, SERVER_PORT))
-                        client_socket.send(b"LIST")
-                        response = client_socket.recv(BUFFER_SIZE).decode()
-
-                    available_files = response.splitlines()
-                    file_info = next((file for file in available_files if file.startswith(filename)), None)
-                    
-                    if file_info:
-                        _, file_size = file_info.split()
-                        download_file(filename, int(file_size))
-                        processed_files.add(filename)
-                    else:
-                        if filename not in non_existent_files:
-                            logging.warning(f"File {filename} not found on the server.")
-                            non_existent_files.add(filename)
+                    available_files.update(request_file_list(parse_endpoint(mirror)))
                 except ConnectionRefusedError:
-                    logging.error("Error connecting to server: Connection refused.")
-                    return
+                    refused += 1
                 except Exception as e:
-                    logging.error(f"Error processing file {filename}: {e}")
-        logging.info("Complete the current list. Wait 5 seconds before checking again...")
-        time.sleep(5)
+                    logging.error(f"Error retrieving file list from {mirror}: {e}")
+            if refused == len(MIRRORS):
+                logging.error("Error connecting to server: Connection refused.")
+                return
+
+            for filename in filenames:
+                if filename in available_files:
+                    download_manager.submit(filename, available_files[filename])
+                    queued_files.add(filename)
+                    non_existent_files.discard(filename)
+                    logging.info(f"Queued {filename} for download")
+                elif filename not in non_existent_files:
+                    logging.warning(f"File {filename} not found on any mirror.")
+                    non_existent_files.add(filename)
+        watcher.wait()
 
 if __name__ == "__main__":
+    # Mirrors can be given on the command line as host:port
+    if len(sys.argv) > 1:
+        MIRRORS = sys.argv[1:]
     print("Client is starting...")
     try:
         process_input_file()
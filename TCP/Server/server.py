@@ -1,8 +1,23 @@
 import os
+import zlib
+import json
+import hashlib
 import socket
+import struct
 import logging
 import threading
 import signal
+from collections import OrderedDict
+
+# Optional codecs, used when installed
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # Setup basic logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -12,12 +27,65 @@ HOST = socket.gethostbyname(socket.gethostname())
 PORT = 12345
 
 FILE_LIST_PATH = "file_list.txt"
+MANIFEST_PATH = "manifest.json"
 SERVER_FILES_DIR = "files"
 BUFFER_SIZE = 4096
 
+# Compression configuration
+COMPRESSION_BLOCK_SIZE = 64 * 1024  # Every block is compressed on its own so any range can be decoded
+COMPRESSION_CACHE_SIZE = 256 * 1024 * 1024  # Bytes of compressed blocks kept in memory for hot files
+INCOMPRESSIBLE_RATIO = 0.9  # Files whose sample does not shrink below this ratio are sent raw
+BLOCK_HEADER = struct.Struct("!BII")  # codec id, raw length, payload length
+CODEC_IDS = {"none": 0, "zlib": 1, "lz4": 2, "zstd": 3}
+
+# Manifest configuration
+HASH_BLOCK_SIZE = COMPRESSION_BLOCK_SIZE  # Same as the compressed blocks, so the ranges a client is missing hit the cache
+MANIFEST_HEADER = struct.Struct("!I")  # length of the JSON payload
+
+COMPRESSORS = {"zlib": lambda data: zlib.compress(data, 6)}
+if lz4 is not None:
+    COMPRESSORS["lz4"] = lz4.frame.compress
+if zstandard is not None:
+    COMPRESSORS["zstd"] = lambda data: zstandard.ZstdCompressor(level=3).compress(data)
+
 # To gracefully stop the server
 server_running = True
 
+class CompressedBlockCache:
+    """Thread-safe LRU cache of compressed blocks, bounded by the total size of the payloads."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.blocks = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is not None:
+                self.blocks.move_to_end(key)
+            return block
+
+    def put(self, key, block):
+        codec, payload = block
+        with self.lock:
+            if key in self.blocks or len(payload) > self.max_bytes:
+                return
+            self.blocks[key] = block
+            self.current_bytes += len(payload)
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted) = self.blocks.popitem(last=False)
+                self.current_bytes -= len(evicted)
+
+compressed_blocks = CompressedBlockCache(COMPRESSION_CACHE_SIZE)
+# (path, mtime, size) -> whether the file is worth compressing
+compressible_files = {}
+# file name -> block hashes and Merkle root of the file, mirrored in MANIFEST_PATH
+file_manifest = {}
+manifest_lock = threading.Lock()  # Guards file_manifest
+manifest_save_lock = threading.Lock()  # Keeps writes of the manifest file in order
+
 def signal_handler(sig, frame):
     """Handle interrupt signal to shut down the server gracefully."""
     global server_running
@@ -56,8 +124,96 @@ def update_file_list():
         logging.info(f"File list successfully updated in {FILE_LIST_PATH}")
     except Exception as e:
         logging.error(f"Error writing to {FILE_LIST_PATH}: {e}")
+    update_manifest(file_list)
     return file_list
 
+def merkle_root(leaves):
+    """Hash pairs of nodes level by level until a single root remains, carrying odd nodes up unchanged."""
+    level = leaves or [hashlib.sha256(b"").hexdigest()]
+    while len(level) > 1:
+        level = [
+            hashlib.sha256("".join(level[i:i + 2]).encode()).hexdigest() if i + 1 < len(level) else level[i]
+            for i in range(0, len(level), 2)
+        ]
+    return level[0]
+
+def build_manifest_entry(file_path):
+    """Hash every block of a file: Adler-32 as the weak hash, SHA-256 as the strong hash and Merkle leaf."""
+    stat = os.stat(file_path)
+    blocks = []
+    with open(file_path, "rb") as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            blocks.append([zlib.adler32(block), hashlib.sha256(block).hexdigest()])
+    logging.info(f"Computed {len(blocks)} block hashes for {file_path}")
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "block_size": HASH_BLOCK_SIZE,
+        "root": merkle_root([strong for _, strong in blocks]),
+        "blocks": blocks,
+    }
+
+def is_manifest_entry_current(entry, file_path):
+    """Check that a manifest entry still describes the file on disk."""
+    stat = os.stat(file_path)
+    return (entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns
+            and entry["block_size"] == HASH_BLOCK_SIZE)
+
+def save_manifest():
+    """Write the manifest to disk so unchanged files are not hashed again on the next start."""
+    temp_path = f"{MANIFEST_PATH}.tmp"
+    try:
+        with manifest_save_lock:
+            with manifest_lock:
+                snapshot = dict(file_manifest)
+            # Swap in a complete file, so a crash while writing never loses the saved manifest
+            with open(temp_path, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(temp_path, MANIFEST_PATH)
+    except Exception as e:
+        logging.error(f"Error writing to {MANIFEST_PATH}: {e}")
+
+def update_manifest(file_list):
+    """Bring the manifest up to date with the file list, hashing only new files and files whose size or mtime changed."""
+    global file_manifest
+    try:
+        with open(MANIFEST_PATH, "r") as f:
+            previous = json.load(f)
+    except FileNotFoundError:
+        previous = {}
+    except Exception as e:
+        logging.error(f"Error reading {MANIFEST_PATH}, rebuilding it: {e}")
+        previous = {}
+
+    manifest = {}
+    for file_name in file_list:
+        file_path = os.path.join(SERVER_FILES_DIR, file_name)
+        entry = previous.get(file_name)
+        if not is_manifest_entry_current(entry, file_path):
+            entry = build_manifest_entry(file_path)
+        manifest[file_name] = entry
+    with manifest_lock:
+        file_manifest = manifest
+    save_manifest()
+    logging.info(f"Manifest successfully updated in {MANIFEST_PATH}")
+
+def get_manifest_entry(file_name):
+    """Return the manifest entry of a file, rehashing it first if it changed since the catalog was built."""
+    file_path = os.path.join(SERVER_FILES_DIR, file_name)
+    with manifest_lock:
+        entry = file_manifest.get(file_name)
+    if is_manifest_entry_current(entry, file_path):
+        return entry
+    # Hash outside the lock, so requests for other files do not wait behind a large file
+    entry = build_manifest_entry(file_path)
+    with manifest_lock:
+        file_manifest[file_name] = entry
+    save_manifest()
+    return entry
+
 def send_chunk(client_socket, file_path, offset, chunk_size):
     """Send a chunk of data from a file to a client over a socket connection."""
     try:
@@ -72,6 +228,87 @@ def send_chunk(client_socket, file_path, offset, chunk_size):
         except Exception as send_error:
             logging.error(f"Error sending error message to client: {send_error}")
 
+def negotiate_codec(offered):
+    """Pick the first codec offered by the client that the server supports."""
+    for codec in offered.split(","):
+        if codec in COMPRESSORS:
+            return codec
+    return "none"
+
+def get_file_signature(file_path):
+    """Identify a version of a file by its path, modification time and size."""
+    stat = os.stat(file_path)
+    return (file_path, stat.st_mtime_ns, stat.st_size)
+
+def is_compressible(file_path, signature):
+    """Compress a sample from the start and the middle of the file to decide if compression pays off."""
+    if signature not in compressible_files:
+        file_size = signature[2]
+        half = COMPRESSION_BLOCK_SIZE // 2
+        if file_size <= 2 * half:
+            # Two samples would overlap, and zlib would take the repeated bytes for redundancy
+            samples = [(0, file_size)]
+        else:
+            samples = [(0, half), (max(half, file_size // 2 - half // 2), half)]
+        sample = b""
+        with open(file_path, "rb") as f:
+            for offset, length in samples:
+                f.seek(offset)
+                sample += f.read(length)
+        compressible = bool(sample) and len(zlib.compress(sample, 1)) < len(sample) * INCOMPRESSIBLE_RATIO
+        compressible_files[signature] = compressible
+        logging.info(f"{file_path} is {'compressible' if compressible else 'incompressible'}")
+    return compressible_files[signature]
+
+def compress_block(codec, data):
+    """Compress one block, falling back to the raw data when compression does not help."""
+    if codec == "none":
+        return "none", data
+    payload = COMPRESSORS[codec](data)
+    if len(payload) >= len(data):
+        return "none", data
+    return codec, payload
+
+def send_compressed_chunk(client_socket, file_path, offset, chunk_size, codec):
+    """Send a chunk of a file as a sequence of independently compressed blocks, ended by an empty block."""
+    try:
+        signature = get_file_signature(file_path)
+        if codec != "none" and not is_compressible(file_path, signature):
+            codec = "none"
+        end = min(offset + chunk_size, signature[2])
+        with open(file_path, "rb") as f:
+            while offset < end:
+                block_index = offset // COMPRESSION_BLOCK_SIZE
+                block_start = block_index * COMPRESSION_BLOCK_SIZE
+                block_end = min(block_start + COMPRESSION_BLOCK_SIZE, signature[2])
+                stop = min(block_end, end)
+                if codec != "none" and offset == block_start and stop == block_end:
+                    # Whole blocks are shared between clients, so they are worth caching
+                    key = signature + (codec, block_index)
+                    block = compressed_blocks.get(key)
+                    if block is None:
+                        f.seek(offset)
+                        block = compress_block(codec, f.read(stop - offset))
+                        compressed_blocks.put(key, block)
+                else:
+                    f.seek(offset)
+                    block = compress_block(codec, f.read(stop - offset))
+                block_codec, payload = block
+                client_socket.sendall(BLOCK_HEADER.pack(CODEC_IDS[block_codec], stop - offset, len(payload)) + payload)
+                offset = stop
+        client_socket.sendall(BLOCK_HEADER.pack(0, 0, 0))
+    except Exception as e:
+        logging.error(f"Error sending compressed chunk: {e}")
+        try:
+            client_socket.sendall(b"ERROR: Unable to send chunk")
+        except Exception as send_error:
+            logging.error(f"Error sending error message to client: {send_error}")
+
+def send_manifest(client_socket, file_name):
+    """Send the manifest entry of a file as length-prefixed JSON."""
+    payload = json.dumps(get_manifest_entry(file_name)).encode()
+    client_socket.sendall(MANIFEST_HEADER.pack(len(payload)) + payload)
+
 def handle_client(client_socket, address):
     """Handle requests from a client."""
     logging.info(f"Connected by {address}")
@@ -91,7 +328,10 @@ def handle_client(client_socket, address):
                     client_socket.sendall(response.encode())
 
                 elif request.startswith("DOWNLOAD"):
-                    _, file_name, offset, chunk_size = request.split(":")
+                    # An optional fifth field lists the codecs accepted by the client
+                    _, file_name, offset, chunk_size, *codecs = request.split(":")
+                    if len(codecs) > 1:
+                        raise ValueError(f"Too many fields in request: {request}")
                     offset = int(offset)
                     chunk_size = int(chunk_size)
 
@@ -101,8 +341,24 @@ def handle_client(client_socket, address):
                         logging.warning(f"File not found: {file_path}")
                         continue
 
-                    send_chunk(client_socket, file_path, offset, chunk_size)
-                    logging.info(f"Sent chunk of file {file_name} to client")
+                    if codecs:
+                        codec = negotiate_codec(codecs[0])
+                        send_compressed_chunk(client_socket, file_path, offset, chunk_size, codec)
+                        logging.info(f"Sent chunk of file {file_name} to client using {codec}")
+                    else:
+                        send_chunk(client_socket, file_path, offset, chunk_size)
+                        logging.info(f"Sent chunk of file {file_name} to client")
+
+                elif request.startswith("MANIFEST"):
+                    _, file_name = request.split(":")
+                    file_path = os.path.join(SERVER_FILES_DIR, file_name)
+                    if not os.path.exists(file_path):
+                        client_socket.sendall(b"ERROR: File not found")
+                        logging.warning(f"File not found: {file_path}")
+                        continue
+
+                    send_manifest(client_socket, file_name)
+                    logging.info(f"Sent manifest of file {file_name} to client")
                 else:
                     client_socket.sendall(b"ERROR: Unknown request")
                     logging.error(f"Unknown request from {address}: {request}")
@@ -1,12 +1,35 @@
 import os
+import zlib
 import json 
+import mmap
+import bisect
 import time 
+import queue
 import socket
+import sys
 import logging
 import hashlib
+import itertools
 import threading
+from collections import deque
+from concurrent.futures import Future
 from tqdm import tqdm  
 
+# Optional codecs, used when installed
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+# Optional, used to watch the input file instead of polling it
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
 # Configuration
 SERVER_HOST = socket.gethostbyname(socket.gethostname())
 SERVER_PORT = 65432
@@ -15,10 +38,186 @@ BUFFER_SIZE = 65535
 DOWNLOAD_FOLDER = "downloads"
 INPUT_FILE = "input.txt"
 TIMEOUT = 2
+COMPRESSED_PART_SIZE = 8 * 1024  # Larger parts compress better and still fit in one datagram when sent raw
+DECOMPRESSORS = {"none": bytes, "zlib": zlib.decompress}
+if lz4 is not None:
+    DECOMPRESSORS["lz4"] = lz4.frame.decompress
+if zstandard is not None:
+    DECOMPRESSORS["zstd"] = lambda payload: zstandard.ZstdDecompressor().decompress(payload)
+# Codecs offered to the server, in order of preference
+ACCEPTED_CODECS = ",".join(codec for codec in ("zstd", "lz4", "zlib") if codec in DECOMPRESSORS)
+ADLER_MOD = 65521
+MANIFEST_RETRIES = 5
+MANIFEST_RESTARTS = 3  # Times the manifest is fetched again from the first page when the file changes meanwhile
+VERIFY_RETRIES = 3  # Times the blocks of a chunk that fail verification are fetched again
+DELTA_GIVE_UP_BYTES = 256 * 1024  # Bytes rolled through without a match before skipping as many bytes of a changed region
+DELTA_UNRELATED_BYTES = 4 * 1024 * 1024  # Stop scanning a local copy that shares nothing with the server's file after this many bytes
+MAX_FILE_SETUPS = 3  # Files looking up their mirrors and manifest at the same time, transfers are not limited
+MAX_BANDWIDTH = 0  # Bytes per second across all downloads, 0 for unlimited
+INPUT_POLL_INTERVAL = 0.5  # Seconds between checks of the input file when inotify is not available
+WATCH_TIMEOUT = 1.0  # Seconds to wait for the input file to change before checking it anyway
+UNTERMINATED_LINE_TIMEOUT = 5.0  # Seconds a last line without a newline must stay unchanged before it is taken as complete
+# Multi-source configuration, every mirror is a host:port download endpoint that serves one stream at a time
+MIRRORS = [f"{SERVER_HOST}:{port}" for port in SERVER_PORTS[:4]]  # The command line overrides it
+RANGE_SIZE = 1024 * 1024  # Unit of work pulled by the sources, faster sources pull more of them
+MAX_TIMEOUTS = 15  # Consecutive timeouts after which a request to a source fails
+MAX_SOURCE_FAILURES = 3  # Failed ranges after which a source is dropped
+SLOW_SOURCE_RATIO = 0.2  # Sources slower than this fraction of the fastest one are dropped
+MIN_SOURCE_SAMPLES = 2  # Ranges a source must complete before its speed is judged
+THROUGHPUT_SMOOTHING = 0.3  # Weight of the latest range in the smoothed throughput of a source
 
 # Setup basic logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+class BandwidthLimiter:
+    """Token bucket shared by every stream, a rate of 0 disables the limit."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last_update = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """Take `amount` bytes from the bucket, sleeping while it is in debt."""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last_update) * self.rate)
+            self.last_update = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+class StreamScheduler:
+    """
+    Run the tasks of each download endpoint on a thread of its own, control requests first and then the
+    streams of smaller downloads.
+
+    A server port serves one stream at a time and would take a request arriving in the middle of a stream
+    for a bad ACK, so every request to an endpoint goes through its thread.
+    """
+
+    def __init__(self):
+        self.queues = {}
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+
+    def submit(self, endpoint, priority, task, *args):
+        with self.lock:
+            if endpoint not in self.queues:
+                self.queues[endpoint] = queue.PriorityQueue()
+                threading.Thread(target=self.run, args=(self.queues[endpoint],), daemon=True).start()
+            self.queues[endpoint].put((priority, next(self.order), task, args))
+
+    def request(self, endpoint, function, *args):
+        """Run a control request on the thread of an endpoint, ahead of every stream, and return a future of its result."""
+        future = Future()
+
+        def task():
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.submit(endpoint, -1, task)
+        return future
+
+    def run(self, tasks):
+        while True:
+            _, _, task, args = tasks.get()
+            try:
+                task(*args)
+            except Exception as e:
+                logging.error(f"Error in stream task: {e}")
+
+stream_scheduler = StreamScheduler()
+bandwidth_limiter = BandwidthLimiter(MAX_BANDWIDTH)
+
+class InputFileWatcher:
+    """Follow the input file and return only the lines appended since the last read."""
+
+    def __init__(self, path):
+        self.path = path
+        self.inode = None
+        self.offset = 0
+        self.pending = b""
+        self.pending_since = 0.0
+        self.inotify = None
+        if INotify is not None:
+            try:
+                self.inotify = INotify()
+                # Watch the directory, editors often replace the file instead of writing to it
+                self.inotify.add_watch(os.path.dirname(os.path.abspath(path)),
+                                       flags.MODIFY | flags.CLOSE_WRITE | flags.CREATE | flags.MOVED_TO)
+            except OSError as e:
+                logging.warning(f"Cannot watch {path} with inotify, polling it instead: {e}")
+                self.inotify = None
+
+    def read_new_lines(self):
+        """Return the complete lines appended since the last call."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return []
+        from_start = stat.st_ino != self.inode or stat.st_size < self.offset
+        if from_start:
+            # The file was replaced or truncated, read it again from the start
+            self.inode, self.offset, self.pending = stat.st_ino, 0, b""
+        data = b""
+        if stat.st_size > self.offset:
+            with open(self.path, "rb") as f:
+                f.seek(self.offset)
+                data = f.read()
+            self.offset += len(data)
+        lines = (self.pending + data).split(b"\n")
+        if data:
+            self.pending_since = time.monotonic()
+        self.pending = lines.pop()
+        if self.pending and (from_start or time.monotonic() - self.pending_since >= UNTERMINATED_LINE_TIMEOUT):
+            # The last line has no newline, take it as complete when the file was read whole or stopped changing long ago
+            lines.append(self.pending)
+            self.pending = b""
+        return [line.decode(errors="replace").strip() for line in lines if line.strip()]
+
+    def wait(self):
+        """Block until the input file may have changed."""
+        if self.inotify is not None:
+            self.inotify.read(timeout=int(WATCH_TIMEOUT * 1000))
+        else:
+            time.sleep(INPUT_POLL_INTERVAL)
+
+class DownloadManager:
+    """Download queued files concurrently, smallest first, sharing the mirrors and bandwidth limit.
+
+    Only the lookup of a file's mirrors and manifest takes one of the setup slots. The transfer then runs in
+    its own thread and is limited by the stream scheduler and bandwidth limiter alone, so a small file queued
+    behind large ones starts right away and its streams overtake theirs.
+    """
+
+    def __init__(self, max_setups):
+        self.queue = queue.PriorityQueue()
+        self.order = itertools.count()
+        for _ in range(max_setups):
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, filename, file_size):
+        self.queue.put((file_size, next(self.order), filename))
+
+    def run(self):
+        while True:
+            file_size, _, filename = self.queue.get()
+            try:
+                manifest, size, sources = choose_sources({filename: file_size}, filename)
+            except Exception as e:
+                logging.error(f"Error downloading {filename}: {e}")
+            else:
+                threading.Thread(target=download_file, args=(filename, manifest, size, sources), daemon=True).start()
+            finally:
+                self.queue.task_done()
+
 def generate_checksum(data):
     """Generate checksum using SHA-256"""
     sha256 = hashlib.sha256()
@@ -26,12 +225,13 @@ def generate_checksum(data):
     return sha256.hexdigest()
 
 class ReliablePacket:
-    def __init__(self, chunk_id, seq_num, data):
+    def __init__(self, chunk_id, seq_num, data, codec="none"):
         """
         Initializes a ReliablePacket instance.
         :param chunk_id: ID of chunk
         :param seq_num: Sequence number of the packet
         :param data: Data of the packet
+        :param codec: Codec the data is compressed with, "none" for raw data
         """
         if not isinstance(data, bytes):
             raise TypeError("data must be of type 'bytes'")
@@ -39,6 +239,7 @@ class ReliablePacket:
         self.chunk_id = chunk_id  
         self.seq_num = seq_num 
         self.data = data 
+        self.codec = codec
         self.checksum = generate_checksum(data)
 
     def serialize(self):
@@ -49,6 +250,7 @@ class ReliablePacket:
             'chunk_id': self.chunk_id,
             'seq_num': self.seq_num,
             'data': self.data.decode('latin-1'), 
+            'codec': self.codec,
             'checksum': self.checksum
         }).encode('utf-8')  
 
@@ -64,145 +266,560 @@ class ReliablePacket:
         return cls(
             chunk_id=packet_dict['chunk_id'],
             seq_num=packet_dict['seq_num'],
-            data=packet_dict['data'].encode('latin-1')  
+            data=packet_dict['data'].encode('latin-1'),
+            codec=packet_dict.get('codec', 'none')
         )
 
 
-def download_chunk(filename, chunk_id, offset, chunk_size, server_port):
-    """Downloads a chunk of a file."""
+def parse_endpoint(mirror):
+    """Split a host:port mirror address."""
+    host, port = mirror.rsplit(":", 1)
+    return host, int(port)
+
+def download_chunk(filename, chunk_id, offset, chunk_size, server_address, manifest=None, part_path=None):
+    """
+    Downloads a chunk of a file, verifying it against the manifest when there is one.
+
+    :return: True if the whole chunk was downloaded
+    """
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     client_socket.settimeout(TIMEOUT)
-    server_address = (SERVER_HOST, server_port)
+    part_path = part_path or f"{DOWNLOAD_FOLDER}/{filename}_part_{chunk_id}"
+    chunk_offset = offset
     seq_num = offset
     conditionStop = offset + chunk_size 
-    progress_bar = tqdm(total=chunk_size, desc=f"Chunk {chunk_id}", unit="B", unit_scale=True, leave=False)
+    timeouts = 0
+    progress_bar = tqdm(total=chunk_size, desc=f"{filename} chunk {chunk_id}", unit="B", unit_scale=True, leave=False)
 
     try:
-        with open(f"{DOWNLOAD_FOLDER}/{filename}_part_{chunk_id}", "wb") as file:
+        with open(part_path, "wb") as file:
             while offset < conditionStop:
-                part_size = min(1024, conditionStop - offset)
-                request = f"DOWNLOAD|{filename}|{offset}|{part_size}|{seq_num}|{chunk_id}".encode()
+                part_size = min(COMPRESSED_PART_SIZE, conditionStop - offset)
+                request = f"DOWNLOAD|{filename}|{offset}|{part_size}|{seq_num}|{chunk_id}|{ACCEPTED_CODECS}".encode()
                 client_socket.sendto(request, server_address)
 
                 try:
                     response, _ = client_socket.recvfrom(BUFFER_SIZE)
+                    bandwidth_limiter.consume(len(response))
                     packet = ReliablePacket.deserialize(response)
                     if packet.chunk_id == chunk_id and packet.seq_num == seq_num:
                         if packet.checksum == generate_checksum(packet.data):
-                            file.write(packet.data)
+                            data = DECOMPRESSORS[packet.codec](packet.data)
+                            if len(data) != part_size:
+                                raise ValueError(f"Part decompressed to {len(data)} bytes, expected {part_size}")
+                            file.write(data)
                             client_socket.sendto(f"ACK_{chunk_id}_{seq_num}".encode(), server_address)
                             seq_num += 1
                             offset += part_size
+                            timeouts = 0
                             progress_bar.update(part_size) 
                         else:
                             logging.warning(f"Checksum mismatch for chunk {chunk_id}, seq_num {seq_num}")
                             client_socket.sendto(f"NACK_{chunk_id}_{seq_num}".encode(), server_address)
                 except socket.timeout:
                     logging.warning(f"Timeout for chunk {chunk_id}, seq_num {seq_num}, size {part_size}")
+                    timeouts += 1
+                    if timeouts >= MAX_TIMEOUTS:
+                        raise TimeoutError(f"No response from {server_address[0]}:{server_address[1]}")
+        if manifest is not None:
+            verify_chunk(filename, chunk_id, chunk_offset, chunk_size, server_address, manifest)
+        return True
     except Exception as e:
         logging.error(f"Error in download_chunk: {e}")
+        return False
     finally:
         progress_bar.close()  
         client_socket.close()
 
-def download_file(file_list, filename):
+def verify_chunk(filename, chunk_id, offset, chunk_size, server_address, manifest):
+    """Check a downloaded chunk against the manifest, fetching again only the blocks that fail."""
+    block_size = manifest['block_size']
+    part_path = f"{DOWNLOAD_FOLDER}/{filename}_part_{chunk_id}"
+    retry_path = f"{part_path}_retry"
+    for attempt in range(VERIFY_RETRIES + 1):
+        corrupt_blocks = []
+        with open(part_path, "rb") as part_file:
+            for start in range(0, chunk_size, block_size):
+                if generate_checksum(part_file.read(block_size)) != manifest['blocks'][(offset + start) // block_size][1]:
+                    corrupt_blocks.append(start)
+        if not corrupt_blocks:
+            return
+        if attempt == VERIFY_RETRIES:
+            break
+        logging.warning(f"Chunk {chunk_id}: {len(corrupt_blocks)} blocks failed verification, fetching them again")
+        with open(part_path, "r+b") as part_file:
+            for start in corrupt_blocks:
+                size = min(block_size, chunk_size - start)
+                download_chunk(filename, chunk_id, offset + start, size, server_address, part_path=retry_path)
+                with open(retry_path, "rb") as retry_file:
+                    part_file.seek(start)
+                    part_file.write(retry_file.read(size))
+                os.remove(retry_path)
+    # Drop the part so a corrupted file is never assembled
+    os.remove(part_path)
+    raise ValueError(f"Chunk {chunk_id} still fails verification after {VERIFY_RETRIES} retries")
+
+def merkle_root(leaves):
+    """Hash pairs of nodes level by level until a single root remains, carrying odd nodes up unchanged."""
+    level = leaves or [generate_checksum(b"")]
+    while len(level) > 1:
+        level = [
+            generate_checksum("".join(level[i:i + 2]).encode()) if i + 1 < len(level) else level[i]
+            for i in range(0, len(level), 2)
+        ]
+    return level[0]
+
+def request_manifest(filename, server_address):
+    """Retrieve the block hashes and Merkle root of a file from a server one page at a time, checking that they agree."""
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client_socket.settimeout(TIMEOUT)
+    blocks = []
+    manifest = None
+    restarts = 0
+
+    try:
+        while manifest is None or len(blocks) < manifest['total']:
+            for _ in range(MANIFEST_RETRIES):
+                client_socket.sendto(f"MANIFEST|{filename}|{len(blocks)}".encode(), server_address)
+                try:
+                    response, _ = client_socket.recvfrom(BUFFER_SIZE)
+                    break
+                except socket.timeout:
+                    logging.warning(f"Timeout requesting the manifest of {filename} from block {len(blocks)}")
+            else:
+                raise TimeoutError(f"No manifest received for {filename}")
+            if response == b"ERR_FILE_NOT_FOUND":
+                raise FileNotFoundError(f"{filename} not found on the server")
+            page = json.loads(response.decode())
+            if page['start'] != len(blocks):
+                continue  # Late reply to an earlier request
+            if manifest is not None and page['root'] != manifest['root']:
+                # The file changed in between, the pages already received describe the old version
+                restarts += 1
+                if restarts > MANIFEST_RESTARTS:
+                    raise ValueError(f"{filename} kept changing while its manifest was fetched")
+                logging.warning(f"{filename} changed while its manifest was fetched, starting over")
+                blocks = []
+                manifest = None
+                continue
+            blocks.extend(page['blocks'])
+            manifest = page
+    finally:
+        client_socket.close()
+    manifest['blocks'] = blocks
+    if merkle_root([strong for _, strong in blocks]) != manifest['root']:
+        raise ValueError(f"Manifest of {filename} does not match its Merkle root")
+    return manifest
+
+class Source:
+    """A download endpoint that has the file being downloaded, with its observed throughput."""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.name = f"{endpoint[0]}:{endpoint[1]}"
+        self.throughput = 0.0  # Bytes per second, smoothed
+        self.samples = 0
+        self.failures = 0
+        self.dropped = False
+
+    def record(self, size, elapsed):
+        rate = size / max(elapsed, 1e-6)
+        if self.samples:
+            rate = (1 - THROUGHPUT_SMOOTHING) * self.throughput + THROUGHPUT_SMOOTHING * rate
+        self.throughput = rate
+        self.samples += 1
+
+class MultiSourceDownload:
+    """
+    Download the ranges of one file from several sources at once.
+
+    Every source runs one stream that pulls ranges from a shared queue, so each source gets a share of the
+    ranges that follows its throughput. A stream fetches one range per task and then queues itself again, so
+    the streams of smaller downloads overtake those of larger ones on the same endpoint. Failed ranges go back
+    to the queue, and sources that keep failing or fall far behind the fastest one are dropped.
+    """
+
+    def __init__(self, filename, ranges, sources, manifest, output_path):
+        self.filename = filename
+        self.sources = sources
+        self.manifest = manifest
+        self.output_path = output_path
+        self.pending = deque((chunk_id, offset, size) for chunk_id, (offset, size) in enumerate(ranges))
+        self.remaining = sum(size for _, size in ranges)  # Bytes left to fetch, the priority of the next stream task
+        self.in_flight = 0
+        self.streaming = set()  # Endpoints with a stream task queued or running
+        self.condition = threading.Condition()
+
+    def run(self):
+        """Download every range, raising if some are left when no source remains."""
+        if not self.sources:
+            raise RuntimeError(f"No source for {self.filename}")
+        with self.condition:
+            self.start_streams()
+            while (self.pending or self.in_flight) and self.streaming:
+                self.condition.wait()
+        if self.pending:
+            raise RuntimeError(f"No source left for {len(self.pending)} ranges of {self.filename}")
+        for source in self.sources:
+            if source.samples:
+                logging.info(f"{self.filename}: {source.name} served {source.samples} ranges at {source.throughput / 1024:.0f} KB/s")
+
+    def start_streams(self):
+        """Queue a stream for every source left without one, called with the condition held."""
+        if not self.pending:
+            return
+        for source in self.sources:
+            if not source.dropped and source.endpoint not in self.streaming:
+                self.streaming.add(source.endpoint)
+                stream_scheduler.submit(source.endpoint, self.remaining, self.work, source)
+
+    def next_range(self, source):
+        """Take the next pending range, ending the stream when there is none."""
+        with self.condition:
+            if source.dropped or not self.pending:
+                self.streaming.discard(source.endpoint)
+                self.condition.notify_all()
+                return None
+            self.in_flight += 1
+            return self.pending.popleft()
+
+    def finish_range(self, byte_range, source, elapsed=None):
+        """Record the outcome of a range, `elapsed` is None when it failed, and queue the stream again."""
+        with self.condition:
+            self.in_flight -= 1
+            if elapsed is None:
+                self.pending.appendleft(byte_range)
+                source.failures += 1
+                if source.failures >= MAX_SOURCE_FAILURES:
+                    source.dropped = True
+                    logging.warning(f"Dropping source {source.name} for {self.filename}: too many failures")
+            else:
+                self.remaining -= byte_range[2]
+                source.record(byte_range[2], elapsed)
+                judged = [other for other in self.sources if not other.dropped and other.samples >= MIN_SOURCE_SAMPLES]
+                if (source.samples >= MIN_SOURCE_SAMPLES and len(judged) > 1
+                        and source.throughput < SLOW_SOURCE_RATIO * max(other.throughput for other in judged)):
+                    source.dropped = True
+                    logging.warning(f"Dropping source {source.name} for {self.filename}: too slow")
+            if not source.dropped and self.pending:
+                stream_scheduler.submit(source.endpoint, self.remaining, self.work, source)
+            else:
+                self.streaming.discard(source.endpoint)
+            # A failed range may need a stream from a source whose stream already ended
+            self.start_streams()
+            self.condition.notify_all()
+
+    def work(self, source):
+        """Fetch one range from a source."""
+        byte_range = self.next_range(source)
+        if byte_range is None:
+            return
+        chunk_id, offset, size = byte_range
+        part_path = f"{DOWNLOAD_FOLDER}/{self.filename}_part_{chunk_id}"
+        elapsed = None
+        try:
+            started = time.monotonic()
+            if download_chunk(self.filename, chunk_id, offset, size, source.endpoint, self.manifest, part_path):
+                elapsed = time.monotonic() - started
+            if elapsed is not None:
+                with open(part_path, "rb") as part_file, open(self.output_path, "r+b") as final_file:
+                    final_file.seek(offset)
+                    final_file.write(part_file.read())
+        except Exception as e:
+            logging.error(f"Error writing chunk {chunk_id} of {self.filename}: {e}")
+            elapsed = None
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        if elapsed is None:
+            logging.warning(f"Source {source.name} failed on the range at {offset} of {self.filename}")
+        self.finish_range(byte_range, source, elapsed)
+
+def split_ranges(ranges, range_size):
+    """Cut (offset, size) ranges into pieces of at most `range_size` bytes."""
+    return [(offset + start, min(range_size, size - start)) for offset, size in ranges for start in range(0, size, range_size)]
+
+def get_range_size(manifest):
+    """Size of the ranges pulled by the sources, a whole number of manifest blocks so each range can be verified."""
+    if manifest is None:
+        return RANGE_SIZE
+    return max(1, RANGE_SIZE // manifest['block_size']) * manifest['block_size']
+
+def roll_checksum(checksum, removed, added, block_size):
+    """Slide an Adler-32 checksum one byte forward over the data."""
+    a = ((checksum & 0xFFFF) - removed + added) % ADLER_MOD
+    b = ((checksum >> 16) - block_size * removed + a - 1) % ADLER_MOD
+    return (b << 16) | a
+
+def find_local_blocks(local_path, blocks, block_size, file_size):
+    """
+    Find the blocks of the server's file that already exist anywhere in the local copy.
+
+    :return: dict mapping block index to the offset of an identical block in the local copy
+    """
+    matches = {}
+    local_size = os.path.getsize(local_path)
+    if local_size == 0 or not blocks:
+        return matches
+    weak_index = {}
+    for index, (weak, strong) in enumerate(blocks):
+        weak_index.setdefault(weak, []).append(index)
+
+    with open(local_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as local:
+        def match_window(position, checksum):
+            """Record the blocks of the server's file identical to the local window at `position`."""
+            candidates = weak_index.get(checksum)
+            if not candidates:
+                return False
+            strong = generate_checksum(local[position:position + block_size])
+            found = [index for index in candidates if blocks[index][1] == strong]
+            for index in found:
+                matches.setdefault(index, position)
+            return bool(found)
+
+        # Blocks that did not move are found with one hash per block
+        aligned = [
+            position for position in range(0, local_size - block_size + 1, block_size)
+            if match_window(position, zlib.adler32(local[position:position + block_size]))
+        ]
+        aligned_set = set(aligned)
+
+        # Roll through the gaps between them, where inserted or removed bytes shifted the blocks,
+        # jumping a whole block after every match
+        position = 0
+        while position + block_size <= local_size:
+            if position in aligned_set:
+                position += block_size
+                continue
+            next_aligned = bisect.bisect_right(aligned, position)
+            gap_end = aligned[next_aligned] if next_aligned < len(aligned) else local_size
+            last_match = position
+            budget = DELTA_GIVE_UP_BYTES
+            checksum = None
+            while position < gap_end and position + block_size <= local_size:
+                if checksum is None:
+                    checksum = zlib.adler32(local[position:position + block_size])
+                if match_window(position, checksum):
+                    position += block_size
+                    last_match = position
+                    budget = DELTA_GIVE_UP_BYTES
+                    checksum = None
+                    continue
+                if position + block_size == local_size:
+                    position = gap_end
+                    break
+                if position - last_match >= budget:
+                    if not matches and position >= DELTA_UNRELATED_BYTES:
+                        # The local copy shares nothing with the server's file
+                        position = local_size
+                        break
+                    # Skip part of the changed region, then roll over one block, which is enough to find
+                    # the blocks after it whatever their shift
+                    position = min(position + DELTA_GIVE_UP_BYTES, gap_end)
+                    last_match = position
+                    budget = block_size
+                    checksum = None
+                    continue
+                checksum = roll_checksum(checksum, local[position], local[position + block_size], block_size)
+                position += 1
+
+        # The last block is usually shorter, look for it at the same offset and at the end of the local copy
+        last_index = len(blocks) - 1
+        last_size = file_size - last_index * block_size
+        if last_index not in matches and last_size < block_size:
+            for offset in (last_index * block_size, local_size - last_size):
+                if 0 <= offset <= local_size - last_size:
+                    if generate_checksum(local[offset:offset + last_size]) == blocks[last_index][1]:
+                        matches[last_index] = offset
+                        break
+    return matches
+
+def verify_blocks(file_path, blocks, block_size):
+    """Check every block of a file against its strong hash."""
+    with open(file_path, "rb") as f:
+        for weak, strong in blocks:
+            if generate_checksum(f.read(block_size)) != strong:
+                return False
+        return not f.read(1)
+
+def delta_sync(filename, manifest, sources):
+    """
+    Update the copy of a file already in the download folder by fetching only the blocks that differ.
+
+    :return: True if the local copy now matches the server's file
+    """
+    local_path = f"{DOWNLOAD_FOLDER}/{filename}"
+    file_size, block_size, blocks = manifest['size'], manifest['block_size'], manifest['blocks']
+    matches = find_local_blocks(local_path, blocks, block_size, file_size)
+
+    # Merge consecutive missing blocks into ranges
+    ranges = []
+    for index in range(len(blocks)):
+        if index in matches:
+            continue
+        offset = index * block_size
+        size = min(block_size, file_size - offset)
+        if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + size)
+        else:
+            ranges.append((offset, size))
+    if not ranges and os.path.getsize(local_path) == file_size and all(matches[index] == index * block_size for index in matches):
+        logging.info(f"{filename} is already up to date")
+        return True
+    logging.info(f"Delta sync of {filename}: reusing {len(matches)} of {len(blocks)} blocks, fetching {sum(size for _, size in ranges)} bytes")
+
+    temp_path = f"{local_path}.delta"
+    try:
+        # Copy the blocks found in the local copy into place, the download fills in the others
+        with open(local_path, "rb") as local_file, open(temp_path, "wb") as final_file:
+            final_file.truncate(file_size)
+            for index, local_offset in matches.items():
+                local_file.seek(local_offset)
+                final_file.seek(index * block_size)
+                final_file.write(local_file.read(min(block_size, file_size - index * block_size)))
+        MultiSourceDownload(filename, split_ranges(ranges, get_range_size(manifest)), sources, manifest, temp_path).run()
+
+        if not verify_blocks(temp_path, blocks, block_size):
+            logging.warning(f"Delta sync of {filename} produced a corrupted file")
+            return False
+        os.replace(temp_path, local_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    logging.info(f"Delta sync completed: {filename}")
+    return True
+
+def find_sources(filename):
+    """Ask every mirror for its file list and return the size of the file on each mirror that has it."""
+    endpoints = [parse_endpoint(mirror) for mirror in MIRRORS]
+    # Ask every mirror at once, each request waits for the range its endpoint is streaming
+    replies = [stream_scheduler.request(endpoint, request_file_list, endpoint) for endpoint in endpoints]
+    sources = {}
+    for endpoint, reply in zip(endpoints, replies):
+        available_files = reply.result()
+        if available_files and filename in available_files:
+            sources[endpoint] = available_files[filename]
+    return sources
+
+def choose_sources(file_list, filename):
+    """Find the mirrors serving the version of a file most of them agree on, returning its manifest, size and sources."""
+    source_sizes = find_sources(filename)
+    if not source_sizes:
+        raise FileNotFoundError(f"{filename} is not on any mirror")
+    # LIST reports the sizes of the server's catalog, which go stale when a file changes while the server runs,
+    # so the manifest of each mirror tells which version of the file it serves
+    manifests = {}
+    replies = {endpoint: stream_scheduler.request(endpoint, request_manifest, filename, endpoint) for endpoint in source_sizes}
+    for endpoint, reply in replies.items():
+        try:
+            manifests[endpoint] = reply.result()
+        except Exception as e:
+            logging.warning(f"No manifest for {filename} from {endpoint[0]}:{endpoint[1]}: {e}")
+    if manifests:
+        # Download the version most mirrors agree on, mirrors holding another version cannot serve its ranges
+        roots = [mirror_manifest['root'] for mirror_manifest in manifests.values()]
+        root = max(roots, key=roots.count)
+        sources = [Source(endpoint) for endpoint, mirror_manifest in manifests.items() if mirror_manifest['root'] == root]
+        manifest = manifests[sources[0].endpoint]
+        file_size = manifest['size']
+    else:
+        manifest = None
+        logging.warning(f"Downloading {filename} without verification")
+        file_size = file_list[filename] if file_list[filename] in source_sizes.values() else next(iter(source_sizes.values()))
+        sources = [Source(endpoint) for endpoint, size in source_sizes.items() if size == file_size]
+    return manifest, file_size, sources
+
+def download_file(filename, manifest, file_size, sources):
     """Manages the file download."""
-    file_size = file_list[filename]
-    chunk_size = file_size // 4
-    threads = []
     if not os.path.exists(DOWNLOAD_FOLDER):
         os.makedirs(DOWNLOAD_FOLDER)
+    if manifest is not None and os.path.isfile(f"{DOWNLOAD_FOLDER}/{filename}"):
+        try:
+            if delta_sync(filename, manifest, sources):
+                return
+        except Exception as e:
+            logging.error(f"Error during delta sync of {filename}: {e}")
+            for source in sources:
+                source.dropped = False
+                source.failures = 0
+    logging.info(f"Downloading {filename} ({file_size} bytes) from {len(sources)} sources")
 
-    for chunk_id in range(4):
-        offset = chunk_id * chunk_size
-        chunk_size = chunk_size if chunk_id != 3 else file_size - offset
-        server_port = SERVER_PORTS[chunk_id]
-        thread = threading.Thread(target=download_chunk, args=(filename, chunk_id, offset, chunk_size, server_port))
-        thread.start()
-        threads.append(thread)
-
-    for thread in threads:
-        thread.join()
-    
-    time.sleep(1)
-    
+    temp_path = f"{DOWNLOAD_FOLDER}/{filename}.part"
     try:
-        with open(f"{DOWNLOAD_FOLDER}/{filename}", "wb") as final_file:
-            for chunk_id in range(4):
-                with open(f"{DOWNLOAD_FOLDER}/{filename}_part_{chunk_id}", "rb") as part_file:
-                    final_file.write(part_file.read())
-                os.remove(f"{DOWNLOAD_FOLDER}/{filename}_part_{chunk_id}")
+        with open(temp_path, "wb") as final_file:
+            final_file.truncate(file_size)
+        MultiSourceDownload(filename, split_ranges([(0, file_size)], get_range_size(manifest)), sources, manifest, temp_path).run()
+        os.replace(temp_path, f"{DOWNLOAD_FOLDER}/{filename}")
     except Exception as e:
-        print(f'Lỗi không thể gộp được file {filename}')
-    finally:
+        print(f'Lỗi không thể tải được file {filename}: {e}')
+    else:
         print()
         print(f" Tải file {filename} thành công!\n")
         print()
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
 
-def request_file_list():
-    """Retrieve the list of available files from the server and display this information."""
+def request_file_list(server_address=(SERVER_HOST, SERVER_PORTS[4])):
+    """Retrieve the list of available files from a server."""
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    server_address = (SERVER_HOST, SERVER_PORTS[4]) # Gửi cho port chỉ phụ trách việc xử lý yêu cầu list
     client_socket.settimeout(TIMEOUT)
 
     try:
         client_socket.sendto("LIST".encode(), server_address)
         response, _ = client_socket.recvfrom(BUFFER_SIZE)
-        if response == b"Server is busy. Try again later.": #Tao thêm chỗ này 
+        if response == b"SERVER_IS_BUSY":
             print("Server is busy. Please try again later.")
             return None  # Trả về None nếu server đang bận
         file_list_str = response.decode()
         file_list = {line.split()[0]: int(line.split()[1]) for line in file_list_str.split("\n") if line.strip()}
         return file_list
     except Exception as e:
-        logging.error(f"Error requesting file list: {e}")
+        logging.error(f"Error requesting file list from {server_address[0]}:{server_address[1]}: {e}")
         return {}
     finally:
         client_socket.close()
 
-def read_input_file():
-    try:
-        with open(INPUT_FILE, "r") as f:
-            return [line.strip() for line in f.readlines()]
-    except FileNotFoundError:
-        return []
-
-def send_disconnect():#Gửi tín hiệu đóng kết nối 
+def send_disconnect():#Gửi tín hiệu đóng kết nối tới mọi server
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    server_address = (SERVER_HOST, SERVER_PORTS[0])
     client_socket.settimeout(TIMEOUT)
-    try:
-        client_socket.sendto(b"DISCONNECT", (SERVER_HOST, SERVER_PORTS[0]))
-        logging.info("Sent DISCONNECT request to server.")
-    except Exception as e:
-        logging.error(f"Error sending DISCONNECT: {e}")
+    for mirror in MIRRORS:
+        try:
+            client_socket.sendto(b"DISCONNECT", parse_endpoint(mirror))
+            logging.info(f"Sent DISCONNECT request to {mirror}.")
+        except Exception as e:
+            logging.error(f"Error sending DISCONNECT to {mirror}: {e}")
+    client_socket.close()
 
 def main(): 
-    downloaded_files = set()
-    file_list = request_file_list()
-    if file_list == None:
+    queued_files = set()
+    mirror_file_lists = [request_file_list(parse_endpoint(mirror)) for mirror in MIRRORS]
+    if all(mirror_files is None for mirror_files in mirror_file_lists):
         return
+    file_list = {}
+    for mirror_files in mirror_file_lists:
+        file_list.update(mirror_files or {})
 
     print("\nDanh sách file từ server:")
     for file_name, size in file_list.items():
         print(f" * {file_name} {size}B")
     print()
+    download_manager = DownloadManager(MAX_FILE_SETUPS)
+    watcher = InputFileWatcher(INPUT_FILE)
     while True:
         try:
-            files_to_download = read_input_file()
-
-            for filename in files_to_download:
-                if filename in downloaded_files:
+            for filename in watcher.read_new_lines():
+                if filename in queued_files:
                     continue
                 
                 if filename in file_list:
-                    download_file(file_list, filename)
-                    downloaded_files.add(filename)  
+                    download_manager.submit(filename, file_list[filename])
+                    queued_files.add(filename)  
+                    logging.info(f"Queued {filename} for download")
                 else:
-                    logging.warning(f"File {filename} is not on the server. Skipping...")
+                    logging.warning(f"File {filename} is not on any mirror. Skipping...")
             
-            logging.info("Complete the current list. Wait 5 seconds before checking again...")
-            time.sleep(5)
+            watcher.wait()
 
         except KeyboardInterrupt:
             logging.info("Client shut down gracefully.")
@@ -210,4 +827,7 @@ def main():
             break
 
 if __name__ == "__main__":
+    # Mirrors can be given on the command line as host:port
+    if len(sys.argv) > 1:
+        MIRRORS = sys.argv[1:]
     main()
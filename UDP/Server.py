@@ -1,5 +1,6 @@
 import os
 import sys
+import zlib
 import json
 import time
 import signal
@@ -7,17 +8,39 @@ import socket
 import hashlib
 import logging
 import threading 
+from collections import OrderedDict
+
+# Optional codecs, used when installed
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # Configuration
 HOST = socket.gethostbyname(socket.gethostname())  
 PORTS = [54000, 55000, 56000, 57000, 58000] 
 BUFFER_SIZE = 65535  
 FILE_LIST_PATH = "file_list.txt"  
+MANIFEST_PATH = "manifest.json"
 FILES_DIR = "files"  
 MAX_RETRIES = 15  
 TIMEOUT = 2  
 stop_event = threading.Event()
-OneClient = 0 
+OneClient = None  # Address of the client host being served, one client at a time
+COMPRESSION_CACHE_SIZE = 128 * 1024 * 1024  # Bytes of compressed parts kept in memory for hot files
+INCOMPRESSIBLE_RATIO = 0.9  # Files whose sample does not shrink below this ratio are sent raw
+COMPRESSION_SAMPLE_SIZE = 32 * 1024
+COMPRESSORS = {"zlib": lambda data: zlib.compress(data, 6)}
+if lz4 is not None:
+    COMPRESSORS["lz4"] = lz4.frame.compress
+if zstandard is not None:
+    COMPRESSORS["zstd"] = lambda data: zstandard.ZstdCompressor(level=3).compress(data)
+HASH_BLOCK_SIZE = 64 * 1024
+MANIFEST_BLOCKS_PER_PACKET = 300  # Block hashes sent per datagram, about 25 KB of JSON
 # Setup basic logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -53,10 +76,15 @@ def update_file_list():
         logging.info(f"File list successfully updated in {FILE_LIST_PATH}")
     except Exception as e:
         logging.error(f"Error writing to {FILE_LIST_PATH}: {e}")
+    update_manifest(file_list)
     return file_list
 
 # Load the list of available files
 file_list = load_file_list()
+# file name -> block hashes and Merkle root of the file, mirrored in MANIFEST_PATH
+file_manifest = {}
+manifest_lock = threading.Lock()  # Guards file_manifest
+manifest_save_lock = threading.Lock()  # Keeps writes of the manifest file in order
 
 def generate_checksum(data):
     """Generate checksum using SHA-256"""
@@ -64,14 +92,102 @@ def generate_checksum(data):
     sha256.update(data)
     return sha256.hexdigest()
 
+def merkle_root(leaves):
+    """Hash pairs of nodes level by level until a single root remains, carrying odd nodes up unchanged."""
+    level = leaves or [generate_checksum(b"")]
+    while len(level) > 1:
+        level = [
+            generate_checksum("".join(level[i:i + 2]).encode()) if i + 1 < len(level) else level[i]
+            for i in range(0, len(level), 2)
+        ]
+    return level[0]
+
+def build_manifest_entry(file_path):
+    """Hash every block of a file: Adler-32 as the weak hash, SHA-256 as the strong hash and Merkle leaf."""
+    stat = os.stat(file_path)
+    blocks = []
+    with open(file_path, "rb") as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            blocks.append([zlib.adler32(block), generate_checksum(block)])
+    logging.info(f"Computed {len(blocks)} block hashes for {file_path}")
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'block_size': HASH_BLOCK_SIZE,
+        'root': merkle_root([strong for _, strong in blocks]),
+        'blocks': blocks
+    }
+
+def is_manifest_entry_current(entry, file_path):
+    """Check that a manifest entry still describes the file on disk."""
+    stat = os.stat(file_path)
+    return (entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns
+            and entry['block_size'] == HASH_BLOCK_SIZE)
+
+def save_manifest():
+    """Write the manifest to disk so unchanged files are not hashed again on the next start."""
+    temp_path = f"{MANIFEST_PATH}.tmp"
+    try:
+        with manifest_save_lock:
+            with manifest_lock:
+                snapshot = dict(file_manifest)
+            # Swap in a complete file, so a crash while writing never loses the saved manifest
+            with open(temp_path, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(temp_path, MANIFEST_PATH)
+    except Exception as e:
+        logging.error(f"Error writing to {MANIFEST_PATH}: {e}")
+
+def update_manifest(file_list):
+    """Bring the manifest up to date with the file list, hashing only new files and files whose size or mtime changed."""
+    global file_manifest
+    try:
+        with open(MANIFEST_PATH, "r") as f:
+            previous = json.load(f)
+    except FileNotFoundError:
+        previous = {}
+    except Exception as e:
+        logging.error(f"Error reading {MANIFEST_PATH}, rebuilding it: {e}")
+        previous = {}
+
+    manifest = {}
+    for file_name in file_list:
+        file_path = os.path.join(FILES_DIR, file_name)
+        entry = previous.get(file_name)
+        if not is_manifest_entry_current(entry, file_path):
+            entry = build_manifest_entry(file_path)
+        manifest[file_name] = entry
+    with manifest_lock:
+        file_manifest = manifest
+    save_manifest()
+    logging.info(f"Manifest successfully updated in {MANIFEST_PATH}")
+
+def get_manifest_entry(file_name):
+    """Return the manifest entry of a file, rehashing it first if it changed since the catalog was built."""
+    file_path = os.path.join(FILES_DIR, file_name)
+    with manifest_lock:
+        entry = file_manifest.get(file_name)
+    if is_manifest_entry_current(entry, file_path):
+        return entry
+    # Hash outside the lock, so requests for other files do not wait behind a large file
+    entry = build_manifest_entry(file_path)
+    with manifest_lock:
+        file_manifest[file_name] = entry
+    save_manifest()
+    return entry
+
 class ReliablePacket:
-    def __init__(self, chunk_id, seq_num, data):
+    def __init__(self, chunk_id, seq_num, data, codec="none"):
         """
         Initializes a ReliablePacket instance.
         
         :param chunk_id: ID of the chunk
         :param seq_num: Sequence number of the packet
         :param data: Data of the packet (must be bytes)
+        :param codec: Codec the data is compressed with, "none" for raw data
         """
         if not isinstance(data, bytes):
             raise TypeError("Data must be of type 'bytes'")
@@ -79,6 +195,7 @@ class ReliablePacket:
         self.chunk_id = chunk_id  
         self.seq_num = seq_num  
         self.data = data  
+        self.codec = codec
         self.checksum = generate_checksum(data)  
 
     def serialize(self):
@@ -91,6 +208,7 @@ class ReliablePacket:
             'chunk_id': self.chunk_id,
             'seq_num': self.seq_num,
             'data': self.data.decode('latin-1'),  
+            'codec': self.codec,
             'checksum': self.checksum
         }).encode('utf-8') 
 
@@ -106,17 +224,96 @@ class ReliablePacket:
         return cls(
             chunk_id=packet_dict['chunk_id'],
             seq_num=packet_dict['seq_num'],
-            data=packet_dict['data'].encode('latin-1')  
+            data=packet_dict['data'].encode('latin-1'),
+            codec=packet_dict.get('codec', 'none')
         )
 
+class CompressedBlockCache:
+    """Thread-safe LRU cache of compressed parts, bounded by the total size of the payloads."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.blocks = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is not None:
+                self.blocks.move_to_end(key)
+            return block
+
+    def put(self, key, block):
+        codec, payload = block
+        with self.lock:
+            if key in self.blocks or len(payload) > self.max_bytes:
+                return
+            self.blocks[key] = block
+            self.current_bytes += len(payload)
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted) = self.blocks.popitem(last=False)
+                self.current_bytes -= len(evicted)
+
+compressed_blocks = CompressedBlockCache(COMPRESSION_CACHE_SIZE)
+# (path, mtime, size) -> whether the file is worth compressing
+compressible_files = {}
+
+def negotiate_codec(offered):
+    """Pick the first codec offered by the client that the server supports."""
+    for codec in offered.split(","):
+        if codec in COMPRESSORS:
+            return codec
+    return "none"
+
+def get_file_signature(file_path):
+    """Identify a version of a file by its path, modification time and size."""
+    stat = os.stat(file_path)
+    return (file_path, stat.st_mtime_ns, stat.st_size)
+
+def is_compressible(file_path, signature):
+    """Compress a sample from the start and the middle of the file to decide if compression pays off."""
+    if signature not in compressible_files:
+        file_size = signature[2]
+        half = COMPRESSION_SAMPLE_SIZE // 2
+        if file_size <= 2 * half:
+            # Two samples would overlap, and zlib would take the repeated bytes for redundancy
+            samples = [(0, file_size)]
+        else:
+            samples = [(0, half), (max(half, file_size // 2 - half // 2), half)]
+        sample = b""
+        with open(file_path, "rb") as f:
+            for offset, length in samples:
+                f.seek(offset)
+                sample += f.read(length)
+        # Compare the sizes on the wire, where the JSON escaping of the data weighs more than its length
+        compressible = bool(sample) and wire_size(zlib.compress(sample, 1)) < wire_size(sample) * INCOMPRESSIBLE_RATIO
+        compressible_files[signature] = compressible
+        logging.info(f"{file_path} is {'compressible' if compressible else 'incompressible'}")
+    return compressible_files[signature]
+
+def wire_size(data):
+    """Size of data once serialized in a packet, where json.dumps escapes bytes above 0x7E and control bytes as \\u00XX."""
+    return len(json.dumps(data.decode('latin-1')))
+
+def compress_block(codec, data):
+    """Compress one part, falling back to the raw data when compression does not make the packet smaller."""
+    if codec == "none":
+        return "none", data
+    payload = COMPRESSORS[codec](data)
+    if wire_size(payload) >= wire_size(data):
+        return "none", data
+    return codec, payload
+
 def handle_list_request(socket, addr):
     """Processes a client's request to list the available files on the server"""
     global OneClient 
-    if OneClient == 1:
+    # The same client may list several ports, it downloads from all of them at once
+    if OneClient is not None and OneClient != addr[0]:
         socket.sendto(b"SERVER_IS_BUSY", addr)  
         return 
     else:
-        OneClient = 1
+        OneClient = addr[0]
     file_list_str = "\n".join([f"{name} {size}" for name, size in file_list.items()])
     socket.sendto(file_list_str.encode(), addr)  
     logging.info(f"Sent file list to {addr}")
@@ -126,7 +323,10 @@ def handle_download_request(socket, addr, data):
     """Handles a client's request to download a file chunk."""
     try:
         request = data.decode().split("|")
-        _, filename, offset, size, seq_num, chunk_id = request
+        # An optional seventh field lists the codecs accepted by the client
+        _, filename, offset, size, seq_num, chunk_id, *codecs = request
+        if len(codecs) > 1:
+            raise ValueError(f"Too many fields in request: {request}")
         offset, size, seq_num, chunk_id = int(offset), int(size), int(seq_num), int(chunk_id)
 
         file_path = os.path.join(FILES_DIR, filename)
@@ -135,22 +335,38 @@ def handle_download_request(socket, addr, data):
             return
         if size <= 0:
             raise ValueError(f"Invalid read size: {size}. Must be > 0 or -1.")
-        with open(file_path, "rb") as f:
-            f.seek(offset)
-            part_data = f.read(size)
-            if not part_data:
-                logging.warning(f"Read empty data for chunk_id={chunk_id}, offset={offset}, size={size}")
-                return 
-        if not isinstance(part_data, bytes):
-            raise TypeError("Data read from file is not in bytes format.")
+        codec = negotiate_codec(codecs[0]) if codecs else "none"
+        signature = get_file_signature(file_path)
+        if codec != "none" and not is_compressible(file_path, signature):
+            codec = "none"
+        # Clients request the same parts of a file every time, so compressed parts are reused across downloads
+        key = signature + (codec, offset, size)
+        block = compressed_blocks.get(key) if codec != "none" else None
+        if block is None:
+            with open(file_path, "rb") as f:
+                f.seek(offset)
+                part_data = f.read(size)
+                if not part_data:
+                    logging.warning(f"Read empty data for chunk_id={chunk_id}, offset={offset}, size={size}")
+                    return 
+            if not isinstance(part_data, bytes):
+                raise TypeError("Data read from file is not in bytes format.")
+            block = compress_block(codec, part_data)
+            if codec != "none":
+                compressed_blocks.put(key, block)
+        block_codec, payload = block
 
-        packet = ReliablePacket(chunk_id=chunk_id, seq_num=seq_num, data=part_data)
+        packet = ReliablePacket(chunk_id=chunk_id, seq_num=seq_num, data=payload, codec=block_codec)
 
         retries = 0
         while retries < MAX_RETRIES:
             try:
                 socket.sendto(packet.serialize(), addr)
-                ack_data, _ = socket.recvfrom(BUFFER_SIZE)
+                ack_data, ack_addr = socket.recvfrom(BUFFER_SIZE)
+                while ack_addr != addr:
+                    # A request from another socket, this port serves one stream at a time
+                    logging.warning(f"Ignoring datagram from {ack_addr} while waiting for the ACK of {addr}")
+                    ack_data, ack_addr = socket.recvfrom(BUFFER_SIZE)
                 ack = ack_data.decode()
                 if ack == f"ACK_{chunk_id}_{seq_num}":
                     logging.info(f"Successfully sent seq_num={seq_num} for chunk {chunk_id}")
@@ -165,6 +381,30 @@ def handle_download_request(socket, addr, data):
         logging.error(f"Error in handle_download_request: {e}")
 
 
+def handle_manifest_request(socket, addr, data):
+    """Sends one page of the manifest of a file, starting at the requested block."""
+    try:
+        _, filename, start = data.decode().split("|")
+        start = int(start)
+
+        file_path = os.path.join(FILES_DIR, filename)
+        if not os.path.exists(file_path):
+            socket.sendto(b"ERR_FILE_NOT_FOUND", addr)
+            return
+        entry = get_manifest_entry(filename)
+        page = {
+            'size': entry['size'],
+            'block_size': entry['block_size'],
+            'root': entry['root'],
+            'total': len(entry['blocks']),
+            'start': start,
+            'blocks': entry['blocks'][start:start + MANIFEST_BLOCKS_PER_PACKET]
+        }
+        socket.sendto(json.dumps(page).encode(), addr)
+    except Exception as e:
+        logging.error(f"Error in handle_manifest_request: {e}")
+
+
 def handle_client(port):
     """Handles client requests on a specific port."""
     global OneClient
@@ -184,8 +424,10 @@ def handle_client(port):
                     handle_list_request(server_socket, addr)
                 elif request == "DOWNLOAD":
                     handle_download_request(server_socket, addr, data)
+                elif request == "MANIFEST":
+                    handle_manifest_request(server_socket, addr, data)
                 elif request == "DISCONNECT":
-                    OneClient = 0 
+                    OneClient = None 
                 else:
                     logging.warning(f"Invalid request from {addr}")
             except socket.timeout:
@@ -203,8 +445,9 @@ def signal_handler(sig, frame):
 
 def start_server():
     """Starts the server and handles multiple ports."""
+    global file_list
     signal.signal(signal.SIGINT, signal_handler)
-    update_file_list()
+    file_list = update_file_list()
     threads = []
     try:
         for port in PORTS: